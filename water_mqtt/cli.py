@@ -3,18 +3,15 @@ This file contains the CLI script entry points
 """
 
 import argparse
-import codecs
-import configparser
+import json
 import logging
 import multiprocessing
+import multiprocessing.connection
 import os
+import re
 import tempfile
-import time
-from typing import Any, Dict, List
-
-from .gpio import gpio_main
-from .http import http_main
-from .mqtt import mqtt_main
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 
 if "INVOCATION_ID" in os.environ:
     # Running under systemd
@@ -36,79 +33,251 @@ DEFAULTS: Dict[str, Any] = {
     "counter_file": "/var/lib/water_mqtt/counter",
 }
 
+# How often to write the counter to disk, in seconds
+COUNTER_WRITE_INTERVAL = 60
+
+# How long to wait for child processes to exit on shutdown, in seconds
+CHILD_EXIT_TIMEOUT = 5
+
+# How to merge command line args into the config. Each entry is
+# (args attribute, config key, whether DEFAULTS has a fallback value)
+CONFIG_MERGE: List[Tuple[str, str, bool]] = [
+    ("mqtt_topic", "mqtt_topic", True),
+    ("mqtt_host", "mqtt_host", False),
+    ("mqtt_port", "mqtt_port", True),
+    ("mqtt_client_id", "mqtt_client_id", True),
+    ("buffer_size", "buffer_size", True),
+    ("gpiochip", "gpiochip", False),
+    ("line", "line", False),
+    ("serial", "serial", False),
+    ("http_host", "http_host", True),
+    ("http_port", "http_port", True),
+    ("counter_file", "counter_file", True),
+]
+
+# Where to cache the parsed config file
+CONFIG_CACHE_FILE = "/var/cache/water_mqtt/config.json"
+
+# Part of the config cache stamp. Increase this whenever
+# parse_config_file changes what it produces, so caches written by
+# older versions are not used.
+CONFIG_CACHE_VERSION = 1
+
+# (cache version, path, st_mtime_ns, st_size)
+ConfigStamp = Tuple[int, str, int, int]
+
+
+class FastConfigParser:
+    """
+    Minimal parser for the flat ini style config files used by this
+    program.
 
-def load_config_file(filename: str) -> Dict[str, Any]:
+    Only supports `[section]` headers, `key = value` (or `key: value`)
+    pairs and full line comments starting with `#` or `;`. Keys are
+    lower cased, like configparser does.
+
+    Unlike configparser there are no multi line values: an indented
+    continuation line is parsed as an option of its own (or rejected,
+    if it contains no `=` or `:`).
     """
-    Load the ini style config file given by `filename`
+
+    SECTION_RE = re.compile(r"^\s*\[([^\]]+)\]\s*$")
+    OPTION_RE = re.compile(r"^\s*([^=:;#\s][^=:]*?)\s*[=:]\s*(.*?)\s*$")
+
+    def __init__(self) -> None:
+        self.sections: Dict[str, Dict[str, str]] = {}
+
+    def read_file(self, configfile) -> None:
+        """
+        Parse the contents of the open file `configfile`
+        """
+        section = None
+        for lineno, line in enumerate(configfile.read().splitlines(), start=1):
+            stripped = line.strip()
+            if not stripped or stripped[0] in "#;":
+                continue
+
+            match = self.SECTION_RE.match(line)
+            if match:
+                section = self.sections.setdefault(match.group(1).strip(), {})
+                continue
+
+            match = self.OPTION_RE.match(line)
+            if not match:
+                raise ValueError(f"line {lineno}: cannot parse {line!r}")
+
+            if section is None:
+                raise ValueError(f"line {lineno}: option outside of a section")
+
+            section[match.group(1).lower()] = match.group(2)
+
+
+def parse_config_file(filename: str) -> Dict[str, Any]:
+    """
+    Parse the ini style config file given by `filename`
     """
 
     config: Dict[str, Any] = {}
-    ini = configparser.ConfigParser()
+    ini = FastConfigParser()
     try:
-        with codecs.open(filename, encoding="utf-8") as configfile:
+        with open(filename, encoding="utf-8") as configfile:
             ini.read_file(configfile)
     except Exception as exc:
         LOGGER.error("Could not read config file %s: %s", filename, exc)
         raise SystemExit(1)  # pylint: disable=raise-missing-from
 
-    if ini.has_option("general", "mqtt-host"):
-        config["mqtt_host"] = ini.get("general", "mqtt-host")
+    general = ini.sections.get("general", {})
+
+    if "mqtt-host" in general:
+        config["mqtt_host"] = general["mqtt-host"]
 
     try:
-        if ini.has_option("general", "mqtt-port"):
-            config["mqtt_port"] = ini.getint("general", "mqtt-port")
+        if "mqtt-port" in general:
+            config["mqtt_port"] = int(general["mqtt-port"])
     except ValueError:
         LOGGER.error(
             "%s: %s is not a valid value for mqtt-port",
             filename,
-            ini.get("general", "mqtt-port"),
+            general["mqtt-port"],
         )
         raise SystemExit(1)  # pylint: disable=raise-missing-from
 
-    if ini.has_option("general", "mqtt-client-id"):
-        config["mqtt_client_id"] = ini.get("general", "mqtt-client-id")
+    if "mqtt-client-id" in general:
+        config["mqtt_client_id"] = general["mqtt-client-id"]
 
-    if ini.has_option("general", "gpiochip"):
-        config["gpiochip"] = ini.get("general", "gpiochip")
+    if "gpiochip" in general:
+        config["gpiochip"] = general["gpiochip"]
 
-    if ini.has_option("general", "line"):
-        config["line"] = ini.getint("general", "line")
+    if "line" in general:
+        config["line"] = int(general["line"])
 
-    if ini.has_option("general", "serial"):
-        config["serial"] = ini.get("general", "serial")
+    if "serial" in general:
+        config["serial"] = general["serial"]
 
     try:
-        if ini.has_option("general", "buffer-size"):
-            config["buffer_size"] = ini.getint("general", "buffer-size")
+        if "buffer-size" in general:
+            config["buffer_size"] = int(general["buffer-size"])
     except ValueError:
         LOGGER.error(
             "%s: %s is not a valid value for buffer-size",
             filename,
-            ini.get("general", "buffer-size"),
+            general["buffer-size"],
         )
         raise SystemExit(1)  # pylint: disable=raise-missing-from
 
-    if ini.has_option("general", "http-host"):
-        config["http_host"] = ini.get("general", "http-host")
+    if "http-host" in general:
+        config["http_host"] = general["http-host"]
 
-    if ini.has_option("general", "counter-file"):
-        config["counter_file"] = ini.get("general", "counter-file")
+    if "counter-file" in general:
+        config["counter_file"] = general["counter-file"]
 
     try:
-        if ini.has_option("general", "http-port"):
-            config["http_port"] = ini.getint("general", "http-port")
+        if "http-port" in general:
+            config["http_port"] = int(general["http-port"])
     except ValueError:
         LOGGER.error(
             "%s: %s is not a valid value for http-port",
             filename,
-            ini.get("general", "http-port"),
+            general["http-port"],
         )
         raise SystemExit(1)  # pylint: disable=raise-missing-from
 
     return config
 
 
-def load_counter(config, counter) -> None:
+def config_stamp(filename: str) -> ConfigStamp:
+    """
+    Return the stamp identifying the current version of the config
+    file `filename` and of the parser, used to validate the parsed
+    config cache
+    """
+    stat = os.stat(filename)
+    return (
+        CONFIG_CACHE_VERSION,
+        os.path.abspath(filename),
+        stat.st_mtime_ns,
+        stat.st_size,
+    )
+
+
+def load_config_cache(stamp: ConfigStamp) -> Optional[Dict[str, Any]]:
+    """
+    Try to load a previously parsed config matching `stamp` from
+    the cache file. Failure to do so is not fatal
+    """
+    try:
+        with open(CONFIG_CACHE_FILE, "r", encoding="utf-8") as cachefile:
+            cached = json.load(cachefile)
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        LOGGER.debug("Could not read config cache %s: %s", CONFIG_CACHE_FILE, exc)
+        return None
+
+    # JSON turns the stamp tuple into a list
+    try:
+        if cached["stamp"] != list(stamp):
+            return None
+        config = cached["config"]
+    except (KeyError, TypeError):
+        LOGGER.debug("Ignoring malformed config cache %s", CONFIG_CACHE_FILE)
+        return None
+
+    if not isinstance(config, dict):
+        LOGGER.debug("Ignoring malformed config cache %s", CONFIG_CACHE_FILE)
+        return None
+
+    return config
+
+
+def write_config_cache(stamp: ConfigStamp, config: Dict[str, Any]) -> None:
+    """
+    Write the parsed config to the cache file.
+    Failure to do so is not fatal
+    """
+    try:
+        with tempfile.NamedTemporaryFile(
+            mode="w",
+            encoding="utf-8",
+            dir=os.path.dirname(CONFIG_CACHE_FILE),
+            delete=False,
+        ) as cachefile:
+            json.dump({"stamp": stamp, "config": config}, cachefile)
+            cachefile.flush()
+            os.fsync(cachefile.fileno())
+            os.replace(cachefile.name, CONFIG_CACHE_FILE)
+    except Exception as exc:
+        LOGGER.debug("Could not write config cache %s: %s", CONFIG_CACHE_FILE, exc)
+
+
+def load_config_file(filename: str) -> Dict[str, Any]:
+    """
+    Load the ini style config file given by `filename`
+
+    The parsed result is cached, keyed by the path, modification
+    time and size of the file, so the file is only parsed again
+    after it has changed.
+    """
+    try:
+        stamp: Optional[ConfigStamp] = config_stamp(filename)
+    except OSError:
+        # Let parse_config_file report the error
+        stamp = None
+
+    if stamp is not None:
+        config = load_config_cache(stamp)
+        if config is not None:
+            LOGGER.debug("Using cached config for %s", filename)
+            return config
+
+    config = parse_config_file(filename)
+    if stamp is not None:
+        write_config_cache(stamp, config)
+
+    return config
+
+
+def load_counter(config, counter, counter_lock) -> None:
     """
     Try to load a counter value from disk.
     Failure to do so is not fatal
@@ -117,16 +286,18 @@ def load_counter(config, counter) -> None:
         with open(config["counter_file"], "r", encoding="utf-8") as counterfile:
             new_counter = int(counterfile.readline())
             LOGGER.info("Read counter %d from %s", new_counter, config["counter_file"])
-            with counter.get_lock():
+            with counter_lock:
                 counter.value = new_counter
     except Exception as exc:
         LOGGER.error("Could not read counter from %s: %s", config["counter_file"], exc)
 
 
-def write_counter(config, counter) -> None:
+def write_counter(config, counter) -> bool:
     """
     Write the counter value to disk.
     Failure to do so is not fatal
+
+    Returns whether the value was written
     """
     try:
         LOGGER.debug(
@@ -134,22 +305,24 @@ def write_counter(config, counter) -> None:
             counter,
             config["counter_file"],
         )
-        with tempfile.NamedTemporaryFile(
-            mode="w+",
-            encoding="utf-8",
-            dir=os.path.dirname(config["counter_file"]),
-            delete=False,
-        ) as counterfile:
-            counterfile.write(f"{counter}")
-            counterfile.flush()
-            os.fsync(counterfile.fileno())
-            os.rename(counterfile.name, config["counter_file"])
+        # Write to a temporary file and move it into place, so the
+        # old value survives a crash in the middle of the write
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(config["counter_file"]))
+        try:
+            os.write(fd, f"{counter}".encode("utf-8"))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmpname, config["counter_file"])
     except Exception as exc:
         LOGGER.error(
             "Error while writing counter to %s: %s",
             config["counter_file"],
             exc,
         )
+        return False
+
+    return True
 
 
 def water_mqtt() -> None:
@@ -202,6 +375,12 @@ def water_mqtt() -> None:
 
     args = parser.parse_args()
 
+    # Imported here so --help and argument errors do not have to load
+    # the GPIO and MQTT libraries
+    from .gpio import gpio_main  # pylint: disable=import-outside-toplevel
+    from .http import http_main  # pylint: disable=import-outside-toplevel
+    from .mqtt import mqtt_main  # pylint: disable=import-outside-toplevel
+
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
@@ -212,59 +391,13 @@ def water_mqtt() -> None:
 
     LOGGER.debug("Config after loading config file: %s", config)
 
-    if args.mqtt_topic:
-        config["mqtt_topic"] = args.mqtt_topic
-    elif "mqtt_topic" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["mqtt_topic"] = DEFAULTS["mqtt_topic"]
-
-    if args.mqtt_host:
-        config["mqtt_host"] = args.mqtt_host
-
-    if args.mqtt_port:
-        config["mqtt_port"] = args.mqtt_port
-    elif "mqtt_port" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["mqtt_port"] = DEFAULTS["mqtt_port"]
-
-    if args.mqtt_client_id:
-        config["mqtt_client_id"] = args.mqtt_client_id
-    elif "mqtt_client_id" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["mqtt_client_id"] = DEFAULTS["mqtt_client_id"]
-
-    if args.buffer_size:
-        config["buffer_size"] = args.buffer_size
-    elif "buffer_size" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["buffer_size"] = DEFAULTS["buffer_size"]
-
-    if args.gpiochip:
-        config["gpiochip"] = args.gpiochip
-
-    if args.line:
-        config["line"] = args.line
-
-    if args.serial:
-        config["serial"] = args.serial
-
-    if args.http_host:
-        config["http_host"] = args.http_host
-    elif "http_host" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["http_host"] = DEFAULTS["http_host"]
-
-    if args.http_port:
-        config["http_port"] = args.http_port
-    elif "http_port" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["http_port"] = DEFAULTS["http_port"]
-
-    if args.counter_file:
-        config["counter_file"] = args.counter_file
-    elif "counter_file" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["counter_file"] = DEFAULTS["counter_file"]
+    for attr, key, has_default in CONFIG_MERGE:
+        value = getattr(args, attr)
+        if value is not None:
+            config[key] = value
+        elif has_default and key not in config:
+            # Not set through config file, not set through CLI, use default
+            config[key] = DEFAULTS[key]
 
     LOGGER.debug("Completed config: %s", config)
 
@@ -284,39 +417,40 @@ def water_mqtt() -> None:
         LOGGER.error("No serial number given")
         raise SystemExit(1)
 
+    # The topic only depends on the serial number, so resolve the
+    # template once here instead of on every publish
+    try:
+        config["mqtt_topic"] = config["mqtt_topic"] % {"serial": config["serial"]}
+    except (KeyError, ValueError, TypeError) as exc:
+        LOGGER.error("Invalid MQTT topic %s: %s", config["mqtt_topic"], exc)
+        raise SystemExit(1)  # pylint: disable=raise-missing-from
+
     water_mqtt_queue: multiprocessing.Queue = multiprocessing.Queue(
         maxsize=config["buffer_size"]
     )
 
-    # Shared variable for the current counter
-    counter = multiprocessing.Value("L")
+    # Shared variable for the current counter, protected by counter_lock
+    counter = multiprocessing.RawValue("L")
+    counter_lock = multiprocessing.Lock()
 
     # Try to read a previously saved counter value
-    load_counter(config, counter)
-    with counter.get_lock():
+    load_counter(config, counter, counter_lock)
+    with counter_lock:
         last_written_value = counter.value
 
-    # Only continue if the counter value is not 0, to prevent incorrect
-    # values being written to MQTT. The non-0 value can come either from
-    # the load_counter call above, or the http process
     procs: List[multiprocessing.Process] = []
 
-    http_proc = multiprocessing.Process(
-        target=http_main, name="http", args=(counter, config)
-    )
-    http_proc.start()
-    procs.append(http_proc)
-
-    LOGGER.info("Waiting for counter to be non 0")
-    while True:
-        with counter.get_lock():
-            if counter.value > 0:
-                break
-
-        time.sleep(1)
+    # Notified by the http server when the counter is set. This uses
+    # counter_lock, so the counter can be checked while holding it.
+    counter_cv = multiprocessing.Condition(counter_lock)
 
+    # The worker processes are forked before the http server thread is
+    # started, so they inherit neither the thread nor its listening
+    # socket. The gpio process waits for the counter to be set itself.
     gpio_proc = multiprocessing.Process(
-        target=gpio_main, name="water", args=(counter, water_mqtt_queue, config)
+        target=gpio_main,
+        name="water",
+        args=(counter, counter_lock, counter_cv, water_mqtt_queue, config),
     )
     gpio_proc.start()
     procs.append(gpio_proc)
@@ -327,40 +461,67 @@ def water_mqtt() -> None:
     mqtt_proc.start()
     procs.append(mqtt_proc)
 
-    # Wait forever for one of the processes to die. If that happens,
-    # kill the whole program.
+    # Written to when the http server stops, which makes the read end
+    # ready for multiprocessing.connection.wait()
+    http_stopped, http_stopped_notify = multiprocessing.Pipe(duplex=False)
+
+    def run_http() -> None:
+        """
+        Run the http server until it fails, and tell the main thread
+        """
+        try:
+            http_main(counter, counter_lock, counter_cv, config)
+        except Exception as exc:
+            LOGGER.error("http server failed: %s", exc)
+        finally:
+            http_stopped_notify.send_bytes(b"")
+
+    # The http server only touches the counter, so it runs as a thread
+    # in this process instead of a process of its own
+    http_thread = threading.Thread(target=run_http, name="http", daemon=True)
+    http_thread.start()
+
+    # Wait forever for one of the processes, or the http server, to die.
+    # If that happens, kill the whole program.
     #
     # Also, write the current counter value to a file every 60
     # seconds, if it has changed.
+    waitables = [http_stopped] + [proc.sentinel for proc in procs]
     run = True
 
-    last_written_time = 0.0
     while run:
         try:
-            for proc in procs:
-                if not proc.is_alive():
-                    LOGGER.error(
-                        "Child process %s died, terminating program", proc.name
-                    )
-                    run = False
+            ready = multiprocessing.connection.wait(
+                waitables, timeout=COUNTER_WRITE_INTERVAL
+            )
 
-            time.sleep(1)
-            if last_written_time < time.time() - 60:
-                last_written_time = time.time()
+            if ready:
+                if http_stopped in ready:
+                    LOGGER.error("http server stopped, terminating program")
 
-                with counter.get_lock():
-                    current_counter = counter.value
+                for proc in procs:
+                    if proc.sentinel in ready:
+                        LOGGER.error(
+                            "Child process %s died, terminating program", proc.name
+                        )
 
-                if current_counter == 0:
-                    # Not set yet, ignore
-                    LOGGER.debug("Counter is 0, not writing")
-                    continue
+                run = False
+                continue
 
-                if current_counter == last_written_value:
-                    LOGGER.debug("Counter has not changed, not writing")
-                    continue
+            with counter_lock:
+                current_counter = counter.value
 
-                write_counter(config, current_counter)
+            if current_counter == 0:
+                # Not set yet, ignore
+                LOGGER.debug("Counter is 0, not writing")
+                continue
+
+            if current_counter == last_written_value:
+                LOGGER.debug("Counter has not changed, not writing")
+                continue
+
+            if write_counter(config, current_counter):
+                last_written_value = current_counter
 
         except KeyboardInterrupt:
             LOGGER.info("Caught keyboard interrupt, exiting")
@@ -370,6 +531,11 @@ def water_mqtt() -> None:
         LOGGER.debug("Terminating %s", proc.name)
         proc.terminate()
 
-    with counter.get_lock():
+    # The gpio process adds its last counted edges to the shared
+    # counter on SIGTERM, wait for that before writing it
+    for proc in procs:
+        proc.join(timeout=CHILD_EXIT_TIMEOUT)
+
+    with counter_lock:
         write_counter(config, counter.value)
     raise SystemExit(1)
@@ -6,17 +6,37 @@ This file contains the GPIO specific parts
 
 import logging
 import multiprocessing
+import queue
+import signal
 import sys
 import time
+from collections import deque
 from datetime import timedelta
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Deque, Dict, Optional
 
 import gpiod
-from gpiod.line import Bias, Edge
+
+try:
+    from gpiod.line import Bias, Edge
+except ImportError as exc:
+    # gpiod.line only exists in the 2.x bindings, the 1.6.x API is
+    # no longer supported
+    raise ImportError(
+        "water-mqtt requires the gpiod 2.x python bindings, "
+        f"found gpiod {getattr(gpiod, '__version__', 'unknown')}"
+    ) from exc
 
 LOGGER = logging.getLogger(__name__)
 
+# How often to send the current counter if no events happen
+HEARTBEAT_INTERVAL = timedelta(seconds=60)
+
+# Counted edges are copied to the shared counter after this many
+# edges, or after this much time, whichever comes first
+SYNC_EDGES = 8
+SYNC_INTERVAL = timedelta(seconds=1)
+
 
 EVENT_NAMES = {
     gpiod.EdgeEvent.Type.RISING_EDGE: "RISING_EDGE",
@@ -24,39 +44,36 @@ EVENT_NAMES = {
 }
 
 
-def event_time(event):
-    """
-    Return the time of the event as a float
-    """
-
-    return event.timestamp_ns / 1_000_000_000
-
-
 def log_events(events):
     """
     Print the contents of the passed event log,
     in reverse order
     """
+    if not LOGGER.isEnabledFor(logging.DEBUG):
+        return
+
+    times = [event.timestamp_ns / 1_000_000_000 for event in events]
+
     LOGGER.debug("Last events:")
     for i in range(0, len(events) - 1):
-        this_time = event_time(events[i])
-        prev_time = event_time(events[i + 1])
         LOGGER.debug(
             "  Event %s at %f, delta %fs",
-            EVENT_NAMES.get(events[i].type, "UNKNOWN"),
-            this_time,
-            this_time - prev_time,
+            EVENT_NAMES.get(events[i].event_type, "UNKNOWN"),
+            times[i],
+            times[i] - times[i + 1],
         )
 
     LOGGER.debug(
         "  Event %s at %f",
-        EVENT_NAMES.get(events[-1].type, "UNKNOWN"),
-        event_time(events[-1]),
+        EVENT_NAMES.get(events[-1].event_type, "UNKNOWN"),
+        times[-1],
     )
 
 
 def gpio_main(
     counter,
+    counter_lock,
+    counter_cv,
     mqtt_queue: multiprocessing.Queue,
     config: Dict[str, Any],
 ) -> None:
@@ -66,9 +83,16 @@ def gpio_main(
     Prepare the event handler for the GPIO pin, wait for events,
     debounce as needed, increase the counter, and push to the queue
 
-    `counter_value` is a shared value between this process and
-    the web server process, to allow changing the value without having
-    to restart the entire program.
+    `counter` is a shared value between this process and
+    the web server thread, to allow changing the value without having
+    to restart the entire program. It is protected by `counter_lock`.
+    Nothing is counted until the counter is non 0, `counter_cv` is
+    notified when the web server thread sets it.
+
+    To avoid taking the shared lock on every edge, counted edges are
+    added to `counter` in batches, and the local copy is refreshed from
+    it at the same time. This keeps edges counted after the web server
+    thread sets a new value.
     """
 
     LOGGER.info("gpio process starting")
@@ -76,81 +100,187 @@ def gpio_main(
     # Count debounced events, for debugging
     debounced = 0
 
-    # Last events received
-    last_events: List[gpiod.EdgeEvent] = []
+    # Last events received, only kept while debug logging is enabled
     keep_last = 10
+    last_events: Deque[gpiod.EdgeEvent] = deque(maxlen=keep_last)
     last_ev_timestamps = {
         gpiod.EdgeEvent.Type.RISING_EDGE: 0,
         gpiod.EdgeEvent.Type.FALLING_EDGE: 0,
     }
 
-    with gpiod.request_lines(
-        config["gpiochip"],
-        consumer=Path(sys.argv[0]).name,
-        config={
-            config["line"]: gpiod.LineSettings(
-                bias=Bias.PULL_UP,
-                edge_detection=Edge.BOTH,
-                debounce_period=timedelta(milliseconds=200),
-            ),
-        },
-    ) as request:
-
-        while True:
-            # Wait for 60 seconds. If nothing happens in that time,
-            # send an event anyway with the current counter
-            res = request.wait_edge_events(timeout=timedelta(seconds=60))
-            if res:
-                for event in request.read_edge_events():
-                    LOGGER.debug(
-                        "Line: %d, Event: %s, Event# %d",
-                        event.line_offset,
-                        EVENT_NAMES.get(event.event_type, "UNKNOWN"),
-                        event.line_seqno,
-                    )
-
-                    last_events.insert(0, event)
-                    last_events = last_events[:keep_last]
-
-                    delta_time = (
-                        event_time(event) - last_ev_timestamps[event.event_type]
-                    )
-                    last_ev_timestamps[event.event_type] = event_time(event)
-                    LOGGER.debug(
-                        "Updating last seen timestamp for %s to %f",
-                        EVENT_NAMES.get(event.event_type, "UNKNOWN"),
-                        event_time(event),
-                    )
-
-                    if delta_time < 0.2:
-                        LOGGER.debug(
-                            "Suspiciously small event delta: %.6fs, ignoring",
-                            delta_time,
-                        )
-                        log_events(last_events)
-                        debounced += 1
-                        continue
-
-                    if event.event_type == gpiod.EdgeEvent.Type.FALLING_EDGE:
-                        with counter.get_lock():
-                            counter.value += 1
+    # Only continue if the counter value is not 0, to prevent incorrect
+    # values being written to MQTT. The non-0 value can come either from
+    # the counter file, or the web server thread
+    LOGGER.info("Waiting for counter to be non 0")
+
+    # Local copy of the counter, and the number of edges counted
+    # since it was last copied to the shared counter
+    with counter_cv:
+        counter_cv.wait_for(lambda: counter.value > 0)
+        local_counter = counter.value
+    unsynced = 0
+    last_sync = time.monotonic()
+
+    # Newest sample not yet handed to the mqtt process
+    pending: Optional[Dict[str, Any]] = None
+
+    # Fields that are the same for every sample, in the order they
+    # are sent
+    data_template: Dict[str, Any] = {
+        "water_mqtt_timestamp": 0,
+        "counter": 0,
+        "debounced": 0,
+        "serial": config["serial"],
+    }
+
+    # A SIGTERM (sent by the main process on shutdown) exits through
+    # SystemExit, so the edges not synced yet are added to the shared
+    # counter before this process ends. It is deferred while a sync
+    # is in progress, so no edges are added twice.
+    in_sync = False
+    stopping = False
+
+    def handle_sigterm(signum, frame) -> None:
+        """
+        Handler for SIGTERM
+        """
+        del signum, frame
+        nonlocal stopping
+
+        stopping = True
+        if not in_sync:
+            raise SystemExit(0)
+
+    def sync_counter() -> None:
+        """
+        Add the edges counted locally to the shared counter, and pick
+        up its current value
+        """
+        nonlocal local_counter, unsynced, last_sync, in_sync
+
+        in_sync = True
+        with counter_lock:
+            counter.value += unsynced
+            local_counter = counter.value
+
+        unsynced = 0
+        last_sync = time.monotonic()
+        in_sync = False
+
+        if stopping:
+            raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    try:
+        with gpiod.request_lines(
+            config["gpiochip"],
+            consumer=Path(sys.argv[0]).name,
+            config={
+                config["line"]: gpiod.LineSettings(
+                    bias=Bias.PULL_UP,
+                    edge_detection=Edge.BOTH,
+                    debounce_period=timedelta(milliseconds=200),
+                ),
+            },
+        ) as request:
+
+            while True:
+                # Wait for 60 seconds. If nothing happens in that time,
+                # send an event anyway with the current counter. If there
+                # are edges not yet copied to the shared counter, only
+                # wait until they are due to be copied.
+                res = request.wait_edge_events(
+                    timeout=SYNC_INTERVAL if unsynced else HEARTBEAT_INTERVAL
+                )
+                publish = True
+                debug = LOGGER.isEnabledFor(logging.DEBUG)
+                if res:
+                    for event in request.read_edge_events():
+                        event_type = event.event_type
+                        event_ts = event.timestamp_ns / 1_000_000_000
+
+                        if debug:
+                            LOGGER.debug(
+                                "Line: %d, Event: %s, Event# %d",
+                                event.line_offset,
+                                EVENT_NAMES.get(event_type, "UNKNOWN"),
+                                event.line_seqno,
+                            )
+                            # The history is only ever used for debug output
+                            last_events.appendleft(event)
+
+                        delta_time = event_ts - last_ev_timestamps[event_type]
+                        last_ev_timestamps[event_type] = event_ts
+                        if debug:
+                            LOGGER.debug(
+                                "Updating last seen timestamp for %s to %f",
+                                EVENT_NAMES.get(event_type, "UNKNOWN"),
+                                event_ts,
+                            )
+
+                        if delta_time < 0.2:
+                            if debug:
+                                LOGGER.debug(
+                                    "Suspiciously small event delta: %.6fs, ignoring",
+                                    delta_time,
+                                )
+                                log_events(last_events)
+                            debounced += 1
+                            continue
+
+                        if event_type == gpiod.EdgeEvent.Type.FALLING_EDGE:
+                            if counter.value != local_counter - unsynced:
+                                # Set through the web server, pick up the new
+                                # value before counting on top of it
+                                sync_counter()
+
+                            local_counter += 1
+                            unsynced += 1
                             LOGGER.info(
                                 "Counter: %d, delta %.6fs (debounced: %d)",
-                                counter.value,
+                                local_counter,
                                 delta_time,
                                 debounced,
                             )
 
-            with counter.get_lock():
-                data = {
-                    "water_mqtt_timestamp": int(time.time() * 1000),
-                    "counter": counter.value,
-                    "debounced": debounced,
-                    "serial": config["serial"],
-                }
-
-            try:
-                mqtt_queue.put(data, block=False)
-            except Exception:
-                # Ignore this
-                pass
+                    # The shared counter only differs from what was last
+                    # synced if the web server set it. Reading it without
+                    # the lock is fine for this check, the sync itself
+                    # takes the lock.
+                    if (
+                        unsynced >= SYNC_EDGES
+                        or time.monotonic() - last_sync
+                        >= SYNC_INTERVAL.total_seconds()
+                        or counter.value != local_counter - unsynced
+                    ):
+                        sync_counter()
+                elif unsynced:
+                    # Quiet after some counted edges, copy them to the
+                    # shared counter without sending anything
+                    sync_counter()
+                    publish = False
+                else:
+                    # Heartbeat, pick up a counter set through the web server
+                    sync_counter()
+
+                if publish:
+                    # The counter only ever increases, so an older sample
+                    # that could not be queued yet is worthless, replace it
+                    pending = data_template.copy()
+                    pending["water_mqtt_timestamp"] = time.time_ns() // 1_000_000
+                    pending["counter"] = local_counter
+                    pending["debounced"] = debounced
+
+                if pending is not None:
+                    try:
+                        mqtt_queue.put(pending, block=False)
+                        pending = None
+                    except queue.Full:
+                        # The mqtt process is behind, retry on the next wakeup
+                        pass
+    finally:
+        if unsynced:
+            # Do not let a second SIGTERM interrupt the final sync
+            in_sync = True
+            sync_counter()
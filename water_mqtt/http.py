@@ -1,64 +1,44 @@
 """
-TODO: replace
+Water meter to MQTT gateway
+
+This file contains the HTTP server used to get and set the counter
 """
 
 import logging
-
-from flask import Flask, request
-from gunicorn.app.base import BaseApplication
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Tuple
+from urllib.parse import parse_qsl, urlsplit
 
 LOGGER = logging.getLogger(__name__)
-APP = Flask(__name__)
 COUNTER = None
+COUNTER_LOCK = None
+COUNTER_CV = None
 
+# Largest request body accepted by /counter/set, in bytes
+MAX_BODY_SIZE = 1024
 
-class StandaloneApplication(BaseApplication):
-    """
-    Base standalone app code from gunicorn docs
-    """
-
-    def __init__(self, app, options=None):
-        self.options = options or {}
-        self.application = app
-        super().__init__()
-
-    def load_config(self):
-        config = {
-            key: value
-            for key, value in self.options.items()
-            if key in self.cfg.settings and value is not None
-        }
-        for key, value in config.items():
-            self.cfg.set(key.lower(), value)
-
-    def load(self):
-        return self.application
 
-    def init(self, parser, opts, args):
-        pass
-
-
-@APP.route("/counter/get", methods=["GET"])
-def handle_counter_get():
+def handle_counter_get() -> Tuple[str, int]:
     """
     Handle a call to the /counter/get endpoint
     """
 
-    with COUNTER.get_lock():
+    with COUNTER_LOCK:
         counter = COUNTER.value
 
     return f"{counter}\n", 200
 
 
-@APP.route("/counter/set", methods=["POST"])
-def handle_counter_set():
+def handle_counter_set(body: str) -> Tuple[str, int]:
     """
     Handle a call to the /counter/set endpoint
+
+    `body` is the url encoded form data of the request
     """
 
     # The value to be set is the first key in the list of
     # values passed in the post
-    keys = list(request.form.keys())
+    keys = [key for key, _ in parse_qsl(body, keep_blank_values=True)]
     if len(keys) < 1:
         return "No value given\n", 400
 
@@ -71,24 +51,94 @@ def handle_counter_set():
         return "Must be positive\n", 400
 
     LOGGER.info("Setting counter to %d", new_counter)
-    with COUNTER.get_lock():
+    # COUNTER_CV shares COUNTER_LOCK, so it can be notified here
+    with COUNTER_LOCK:
         COUNTER.value = new_counter
+        COUNTER_CV.notify_all()
 
     return "OK\n", 200
 
 
-def http_main(counter, config):
+class CounterRequestHandler(BaseHTTPRequestHandler):
+    """
+    Request handler dispatching to the counter endpoints
     """
-    Main function for the http subprocess
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Handle a GET request
+        """
+        path = urlsplit(self.path).path
+        if path == "/counter/get":
+            self.reply(*handle_counter_get())
+        elif path == "/counter/set":
+            self.reply("Method not allowed\n", 405)
+        else:
+            self.reply("Not found\n", 404)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Handle a POST request
+        """
+        path = urlsplit(self.path).path
+        if path == "/counter/set":
+            length_header = self.headers.get("Content-Length")
+            if length_header is None:
+                self.reply("Length required\n", 411)
+                return
+
+            try:
+                length = int(length_header)
+            except ValueError:
+                self.reply("Invalid Content-Length\n", 400)
+                return
+
+            if length < 0:
+                self.reply("Invalid Content-Length\n", 400)
+                return
+
+            if length > MAX_BODY_SIZE:
+                self.reply("Request too large\n", 413)
+                return
+
+            body = self.rfile.read(length).decode("utf-8", errors="replace")
+            self.reply(*handle_counter_set(body))
+        elif path == "/counter/get":
+            self.reply("Method not allowed\n", 405)
+        else:
+            self.reply("Not found\n", 404)
+
+    def reply(self, text: str, status: int) -> None:
+        """
+        Send `text` as a plain text response with HTTP status `status`
+        """
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        LOGGER.debug("%s - %s", self.address_string(), format % args)
+
+
+def http_main(counter, counter_lock, counter_cv, config):
+    """
+    Main function for the http server thread
+
+    `counter` is protected by `counter_lock`. `counter_cv` is
+    notified every time the counter is set
     """
 
-    LOGGER.info("http process starting")
+    LOGGER.info("http server starting")
 
-    global COUNTER  # pylint: disable=global-statement
+    global COUNTER, COUNTER_LOCK, COUNTER_CV  # pylint: disable=global-statement
     COUNTER = counter
+    COUNTER_LOCK = counter_lock
+    COUNTER_CV = counter_cv
 
-    options = {
-        "bind": f"{config['http_host']}:{config['http_port']}",
-        "workers": 1,
-    }
-    StandaloneApplication(APP, options).run()
+    server = ThreadingHTTPServer(
+        (config["http_host"], config["http_port"]), CounterRequestHandler
+    )
+    server.serve_forever()
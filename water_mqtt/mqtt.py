@@ -116,10 +116,5 @@ def mqtt_main(queue: multiprocessing.Queue, config: Dict[str, Any]) -> None:
             LOGGER.error("mqtt publishing thread died, bailing out")
             raise SystemExit(1)
 
-        client.publish(
-            config["mqtt_topic"]
-            % {
-                "serial": config["serial"],
-            },
-            json.dumps(data),
-        )
+        # mqtt_topic has already been resolved for the serial number
+        client.publish(config["mqtt_topic"], json.dumps(data))